@@ -1,4 +1,8 @@
+import asyncio
 import io
+import os
+import re
+import signal
 import sys
 from collections import namedtuple
 import socket
@@ -17,10 +21,22 @@ COMMAND_UNREC = "500 Syntax error: command unrecognized"
 PARAM_ERROR = "501 Syntax error in parameters or arguments"
 OUT_OF_ORDER_ERROR = "503 Bad sequence of commands"
 
+COMMAND_UNREC_REPLY = b"%s\r\n" % COMMAND_UNREC.encode()
+PARAM_ERROR_REPLY = b"%s\r\n" % PARAM_ERROR.encode()
+OUT_OF_ORDER_REPLY = b"%s\r\n" % OUT_OF_ORDER_ERROR.encode()
+
 # Connection
 HOST_NAME = "localhost"
 PORT = 9900
 MAX_CONN_QUEUE = 5
+READ_SIZE = 65536
+SOCKET_BUFFER_SIZE = 262144
+
+# Forwarding
+FORWARD_DIR = "forward/"
+MAX_FORWARD_FILES = 128
+
+forward_files = {}
 
 # OK Types
 OK = 250
@@ -32,18 +48,60 @@ OK_MSG = "%d OK" % OK
 ENTER_DATA_MSG = "%d Start mail input; end with <CRLF>.<CRLF>" % ENTER_DATA
 QUIT_MSG = "%d %s closing connection" % (QUIT, HOST_NAME)
 
+OK_REPLY = b"%s\r\n" % OK_MSG.encode()
+ENTER_DATA_REPLY = b"%s\r\n" % ENTER_DATA_MSG.encode()
+QUIT_REPLY = b"%s\r\n" % QUIT_MSG.encode()
+GREETING_REPLY = b"%d %s\r\n" % (GREETING, HOST_NAME.encode())
+EXTENSIONS_REPLY = b"%d PIPELINING\r\n" % OK
+
 Token = namedtuple("Token", ["type", "spelling"])
+EOF_TOKEN = Token(EOF, "\0")
+
+SPECIAL = {"<", ">", "(", ")", "[", "]", "\\", ".", ",", ";", ":", "@", "\""}
+
+# Token type of every ASCII character, indexed by code point
+CHAR_CLASS = [CHAR] * 128
+CHAR_CLASS[ord("\t")] = SPACE
+CHAR_CLASS[ord(" ")] = SPACE
+CHAR_CLASS[ord("\n")] = NEWLINE
+for special in SPECIAL:
+    CHAR_CLASS[ord(special)] = SPEC
+CHAR_CLASS = tuple(CHAR_CLASS)
+
+# Letters, and letters or digits, among the ASCII characters, indexed by code point
+ALPHA = bytes(1 if chr(c).isalpha() else 0 for c in range(128))
+ALNUM = bytes(1 if chr(c).isalnum() else 0 for c in range(128))
 
+# Command line patterns, matching exactly what the token parsers accept
+USER_PATTERN = "[%s]+" % "".join(re.escape(chr(c)) for c in range(128) if CHAR_CLASS[c] == CHAR)
+DOMAIN_PATTERN = "[A-Za-z][A-Za-z0-9]*(?:\\.[A-Za-z][A-Za-z0-9]*)*"
+PATH_PATTERN = "<(%s)@(%s)>" % (USER_PATTERN, DOMAIN_PATTERN)
 
-def is_ascii(s):
-    return all(ord(c) < 128 for c in s)
+MAILBOX_RE = re.compile("(%s)@(%s)" % (USER_PATTERN, DOMAIN_PATTERN))
+
+MAIL_RE = re.compile("MAIL[ \t]+FROM:[ \t]*%s[ \t]*\n" % PATH_PATTERN)
+RCPT_RE = re.compile("RCPT[ \t]+TO:[ \t]*%s[ \t]*\n" % PATH_PATTERN)
+DATA_RE = re.compile("DATA[ \t]*\n")
+HELO_RE = re.compile("HELO[ \t]+(%s)[ \t]*\n" % DOMAIN_PATTERN)
+EHLO_RE = re.compile("EHLO[ \t]+(%s)[ \t]*\n" % DOMAIN_PATTERN)
+RSET_RE = re.compile("RSET[ \t]*\n")
+
+# A line holding only "." and trailing whitespace ends the mail data
+DATA_END_RE = re.compile(rb"(?m)^\.[ \t\r\x0b\x0c]*\n")
+# The period a client adds in front of data lines starting with one
+DOT_STUFFING_RE = re.compile(rb"(?m)^\.")
 
 
 class TokenScanner:
-    SPECIAL = {"<", ">", "(", ")", "[", "]", "\\", ".", ",", ";", ":", "@", "\""}
+    SPECIAL = SPECIAL
+    __slots__ = ("buf", "pos", "current")
 
     def __init__(self, instream):
-        self.instream = instream
+        self.reset(instream.read())
+
+    def reset(self, line):
+        self.buf = line
+        self.pos = 0
         self.current = self.read_token()
 
     def accept(self, token_type=0, spelling=None):
@@ -56,46 +114,57 @@ class TokenScanner:
             self.current = self.read_token()
         return acceptable
 
+    def accept_literal(self, literal):
+        if self.current.type == EOF:
+            return False
+        start = self.pos - 1
+        if not self.buf.startswith(literal, start):
+            return False
+        self.seek(start + len(literal))
+        return True
+
+    def seek(self, pos):
+        self.pos = pos
+        self.current = self.read_token()
+
     def read_token(self):
-        next_char = self.instream.read(1)
-        if not next_char:
-            return Token(EOF, "\0")
-        if next_char == "\t" or next_char == " ":
-            return Token(SPACE, next_char)
-        if next_char == "\n":
-            return Token(NEWLINE, next_char)
-        if next_char in TokenScanner.SPECIAL:
-            return Token(SPEC, next_char)
-        if is_ascii(next_char):
-            return Token(CHAR, next_char)
+        if self.pos >= len(self.buf):
+            return EOF_TOKEN
+        next_char = self.buf[self.pos]
+        self.pos += 1
+        code = ord(next_char)
+        if code < 128:
+            return Token(CHAR_CLASS[code], next_char)
         return Token(UNREC, next_char)
 
 
 class ParseException(BaseException):
 
-    def __init__(self, error):
+    def __init__(self, error, reply=None):
         BaseException.__init__(self, error)
+        self.reply = reply if reply is not None else b"%s\r\n" % error.encode()
 
 
 class UnrecognizedCommandException(ParseException):
 
     def __init__(self):
-        ParseException.__init__(self, COMMAND_UNREC)
+        ParseException.__init__(self, COMMAND_UNREC, COMMAND_UNREC_REPLY)
 
 
 class ParameterErrorException(ParseException):
 
     def __init__(self):
-        ParseException.__init__(self, PARAM_ERROR)
+        ParseException.__init__(self, PARAM_ERROR, PARAM_ERROR_REPLY)
 
 
 class OutOfOrderException(ParseException):
 
     def __init__(self):
-        ParseException.__init__(self, OUT_OF_ORDER_ERROR)
+        ParseException.__init__(self, OUT_OF_ORDER_ERROR, OUT_OF_ORDER_REPLY)
 
 
 class MailBox:
+    __slots__ = ("user", "domain")
 
     def __init__(self, user, domain):
         self.user = user
@@ -106,6 +175,7 @@ class MailBox:
 
 
 class Mail:
+    __slots__ = ("src", "targets", "text")
 
     def __init__(self, src, rcpts, text):
         self.src = src
@@ -119,23 +189,85 @@ class ClientQuit(BaseException):
         BaseException.__init__(self)
 
 
-def accept_literal_str(scanner, string):
-    for s in string:
-        if not scanner.accept(spelling=s):
-            return False
-    return True
+class ClientReset(BaseException):
 
+    def __init__(self):
+        BaseException.__init__(self)
 
-def parse_mail_from_cmd(scanner):
-    try:
-        if not accept_literal_str(scanner, "MAIL"):
-            raise UnrecognizedCommandException()
-        parse_whitespace(scanner)
-        if not accept_literal_str(scanner, "FROM:"):
-            raise UnrecognizedCommandException()
-    except ParseException:
-        raise UnrecognizedCommandException()
 
+class ClientReader:
+    __slots__ = ("stream", "buf")
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.buf = bytearray()
+
+    def has_line(self):
+        return b"\n" in self.buf
+
+    async def fill(self):
+        chunk = await self.stream.read(READ_SIZE)
+        self.buf += chunk
+        return len(chunk) > 0
+
+    async def readline(self):
+        end = self.buf.find(b"\n")
+        while end < 0:
+            searched = len(self.buf)
+            if not await self.fill():
+                line = bytes(self.buf)
+                self.buf.clear()
+                return line.decode()
+            end = self.buf.find(b"\n", searched)
+        if end > 0 and self.buf[end - 1] == 13:
+            line = bytes(self.buf[:end - 1]) + b"\n"
+        else:
+            line = bytes(self.buf[:end + 1])
+        del self.buf[:end + 1]
+        return line.decode()
+
+    async def read_data(self):
+        match = DATA_END_RE.search(self.buf)
+        while not match:
+            searched = max(self.buf.rfind(b"\n"), 0)
+            if not await self.fill():
+                return None
+            match = DATA_END_RE.search(self.buf, searched)
+        data = DOT_STUFFING_RE.sub(b"", self.buf[:match.start()]).replace(b"\r\n", b"\n")
+        del self.buf[:match.end()]
+        return data.decode()
+
+
+class Responder:
+    __slots__ = ("writer", "buf")
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.buf = bytearray()
+
+    def ok(self):
+        self.buf += OK_REPLY
+
+    def write(self, reply):
+        self.buf += reply
+
+    def send(self, msg):
+        self.buf += msg.encode()
+        self.buf += b"\r\n"
+
+    async def flush(self):
+        if self.buf:
+            self.writer.write(bytes(self.buf))
+            self.buf.clear()
+            await self.writer.drain()
+
+    def close(self):
+        self.writer.close()
+
+
+def parse_mail_from_tokens(scanner):
+    if not (scanner.accept_literal("MAIL") and accept_whitespace(scanner) and scanner.accept_literal("FROM:")):
+        raise UnrecognizedCommandException()
     parse_nullspace(scanner)
     path = parse_path(scanner)
     parse_nullspace(scanner)
@@ -144,16 +276,21 @@ def parse_mail_from_cmd(scanner):
     return path
 
 
-def parse_whitespace(scanner):
+def accept_whitespace(scanner):
     if not scanner.accept(SPACE):
-        raise ParameterErrorException()
+        return False
     while scanner.current.type == SPACE:
         scanner.accept(SPACE)
+    return True
+
+
+def parse_whitespace(scanner):
+    if not accept_whitespace(scanner):
+        raise ParameterErrorException()
 
 
 def parse_nullspace(scanner):
-    if scanner.current.type == SPACE:
-        parse_whitespace(scanner)
+    accept_whitespace(scanner)
 
 
 def parse_path(scanner):
@@ -165,7 +302,23 @@ def parse_path(scanner):
     return mail_box
 
 
+def match_mailbox(buf, pos):
+    match = MAILBOX_RE.match(buf, pos)
+    if not match:
+        return None
+    end = match.end()
+    if end < len(buf) and (buf[end] == "." or buf[end] >= "\x80"):
+        return None
+    return match.start(1), match.end(1), match.start(2), end
+
+
 def parse_mailbox(scanner):
+    if scanner.current.type == CHAR:
+        spans = match_mailbox(scanner.buf, scanner.pos - 1)
+        if spans:
+            user_start, user_end, domain_start, domain_end = spans
+            scanner.seek(domain_end)
+            return MailBox(scanner.buf[user_start:user_end], scanner.buf[domain_start:domain_end])
     user = parse_string(scanner)
     if not scanner.accept(SPEC, "@"):
         raise ParameterErrorException()
@@ -173,6 +326,14 @@ def parse_mailbox(scanner):
     return MailBox(user, domain)
 
 
+def parse_mailbox_str(line):
+    spans = match_mailbox(line, 0)
+    if spans:
+        user_start, user_end, domain_start, domain_end = spans
+        return MailBox(line[user_start:user_end], line[domain_start:domain_end])
+    return parse_mailbox(TokenScanner(io.StringIO(line)))
+
+
 def parse_string(scanner):
     result = [scanner.current.spelling]
     if not scanner.accept(CHAR):
@@ -185,66 +346,45 @@ def parse_string(scanner):
 
 def parse_domain(scanner):
     result = [parse_element(scanner)]
-    if scanner.current.type == SPEC and scanner.current.spelling == ".":
-        result.append(scanner.current.spelling)
+    while scanner.current.type == SPEC and scanner.current.spelling == ".":
         scanner.accept(SPEC, ".")
-        result.append(parse_domain(scanner))
+        result.append(".")
+        result.append(parse_element(scanner))
     return "".join(result)
 
 
 def accept_letter(scanner):
     result = None
-    if scanner.current.type == CHAR and scanner.current.spelling.isalpha():
+    if scanner.current.type == CHAR and ALPHA[ord(scanner.current.spelling)]:
         result = scanner.current.spelling
-        scanner.accept(CHAR, scanner.current.spelling)
+        scanner.accept()
     return result
 
 
 def parse_element(scanner):
-    result = []
     letter = accept_letter(scanner)
     if not letter:
         raise ParameterErrorException()
-    result.append(letter)
-
-    if not scanner.current.type == CHAR:
-        return "".join(result)
-    if scanner.current.spelling.isalpha() or scanner.current.spelling.isdigit():
-        result.append(parse_letter_digit_string(scanner))
-    return "".join(result)
+    return letter + parse_letter_digit_string(scanner)
 
 
 def parse_letter_digit_string(scanner):
-    result = [parse_letter_digit(scanner)]
-
-    if not scanner.current.type == CHAR:
-        return "".join(result)
-    while scanner.current.spelling.isalpha() or scanner.current.spelling.isdigit():
-        result.append(parse_letter_digit(scanner))
-    return "".join(result)
-
-
-def parse_letter_digit(scanner):
-    if scanner.current.type != CHAR:
-        raise ParameterErrorException()
-    if scanner.current.spelling.isalpha() or scanner.current.spelling.isdigit():
-        result = scanner.current.spelling
-        scanner.accept(CHAR, scanner.current.spelling)
-        return result
-    else:
+    if scanner.current.type == EOF:
+        return ""
+    buf = scanner.buf
+    start = end = scanner.pos - 1
+    while end < len(buf) and buf[end] < "\x80" and ALNUM[ord(buf[end])]:
+        end += 1
+    if end < len(buf) and buf[end].isalnum():
         raise ParameterErrorException()
+    if end > start:
+        scanner.seek(end)
+    return buf[start:end]
 
 
-def parse_rcpt_to(scanner):
-    try:
-        if not accept_literal_str(scanner, "RCPT"):
-            raise UnrecognizedCommandException()
-        parse_whitespace(scanner)
-        if not accept_literal_str(scanner, "TO:"):
-            raise UnrecognizedCommandException()
-    except ParseException:
+def parse_rcpt_to_tokens(scanner):
+    if not (scanner.accept_literal("RCPT") and accept_whitespace(scanner) and scanner.accept_literal("TO:")):
         raise UnrecognizedCommandException()
-
     parse_nullspace(scanner)
     path = parse_path(scanner)
     parse_nullspace(scanner)
@@ -253,16 +393,24 @@ def parse_rcpt_to(scanner):
     return path
 
 
-def parse_data_cmd(scanner):
-    if not accept_literal_str(scanner, "DATA"):
+def parse_data_tokens(scanner):
+    if not scanner.accept_literal("DATA"):
         raise UnrecognizedCommandException()
     parse_nullspace(scanner)
     if not scanner.accept(NEWLINE):
         raise ParameterErrorException()
 
 
-def parse_helo_cmd(scanner):
-    if not accept_literal_str(scanner, "HELO"):
+def parse_helo_tokens(scanner):
+    return parse_greeting_tokens(scanner, "HELO")
+
+
+def parse_ehlo_tokens(scanner):
+    return parse_greeting_tokens(scanner, "EHLO")
+
+
+def parse_greeting_tokens(scanner, command):
+    if not scanner.accept_literal(command):
         raise UnrecognizedCommandException()
     parse_whitespace(scanner)
     domain = parse_domain(scanner)
@@ -272,155 +420,244 @@ def parse_helo_cmd(scanner):
     return domain
 
 
-def parse_data_txt(server_in, server_out):
-    result = []
-    for line in server_in:
-        if line.rstrip() == ".":
-            return "".join(result)
-        result.append(line)
+def command_parser(name, command_re, parse_tokens, build):
+    match_line = command_re.match
+
+    def parse_command(line, scanner):
+        match = match_line(line)
+        if match:
+            return build(*match.groups())
+        scanner.reset(line)
+        return parse_tokens(scanner)
+
+    parse_command.__name__ = parse_command.__qualname__ = name
+    return parse_command
+
+
+def no_argument():
+    return None
 
 
-def try_parse(line, expected, funcs):
+parse_mail_from_cmd = command_parser("parse_mail_from_cmd", MAIL_RE, parse_mail_from_tokens, MailBox)
+parse_rcpt_to = command_parser("parse_rcpt_to", RCPT_RE, parse_rcpt_to_tokens, MailBox)
+parse_data_cmd = command_parser("parse_data_cmd", DATA_RE, parse_data_tokens, no_argument)
+parse_helo_cmd = command_parser("parse_helo_cmd", HELO_RE, parse_helo_tokens, str)
+parse_ehlo_cmd = command_parser("parse_ehlo_cmd", EHLO_RE, parse_ehlo_tokens, str)
+
+
+async def parse_data_txt(server_in, server_out):
+    await server_out.flush()
+    data = await server_in.read_data()
+    if data is None:
+        raise ClientQuit()
+    return data
+
+
+def try_parse(line, expected, funcs, scanner):
     if line.strip() == "":
         raise UnrecognizedCommandException()
-    stream = io.StringIO(line)
-    tok_scanner = TokenScanner(stream)
-    if tok_scanner.current.spelling[0] not in funcs:
-        raise UnrecognizedCommandException()
-    f = funcs[tok_scanner.current.spelling[0]]
-    if f:
-        try:
-            parsed = f(tok_scanner)
-            if f not in expected:
-                raise OutOfOrderException()
-            return f, parsed
-        except ParameterErrorException:
-            if f not in expected:
-                raise OutOfOrderException()
-            else:
-                raise
-    else:
+    f = funcs.get(line[0])
+    if not f:
         raise UnrecognizedCommandException()
+    try:
+        parsed = f(line, scanner)
+    except ParameterErrorException:
+        if f not in expected:
+            raise OutOfOrderException()
+        raise
+    if f not in expected:
+        raise OutOfOrderException()
+    return f, parsed
 
 
-PARSERS = {"M": parse_mail_from_cmd, "R": parse_rcpt_to, "D": parse_data_cmd, "H": parse_helo_cmd}
+PARSERS = {"M": parse_mail_from_cmd, "R": parse_rcpt_to, "D": parse_data_cmd, "H": parse_helo_cmd,
+           "E": parse_ehlo_cmd}
 
 
-def handle_quit(server_out):
-    print(QUIT_MSG, file=server_out, flush=True)
+async def handle_quit(server_out):
+    server_out.write(QUIT_REPLY)
+    await server_out.flush()
 
 
-def read_next_line(server_in, server_out):
-    try:
-        line = next(server_in)
-        if line.strip() == "QUIT":
-            handle_quit(server_out)
-            raise ClientQuit()
-        return line
-    except StopIteration:
-        exit(0)
+async def read_next_line(server_in, server_out):
+    if not server_in.has_line():
+        await server_out.flush()
+    line = await server_in.readline()
+    if not line:
+        raise ClientQuit()
+    if line.strip() == "QUIT":
+        await handle_quit(server_out)
+        raise ClientQuit()
+    if RSET_RE.match(line):
+        raise ClientReset()
+    return line
 
 
-def accept_rcpt_to(server_in, server_out):
+async def accept_rcpt_to(server_in, server_out, scanner):
     rcpts = []
-    rcpt_line = read_next_line(server_in, server_out)
-    f, rcpt_addr = try_parse(rcpt_line, [parse_rcpt_to], PARSERS)
+    rcpt_line = await read_next_line(server_in, server_out)
+    f, rcpt_addr = try_parse(rcpt_line, [parse_rcpt_to], PARSERS, scanner)
     while f == parse_rcpt_to:
-        print(OK_MSG, file=server_out, flush=True)
+        server_out.ok()
         rcpts.append(rcpt_addr)
-        rcpt_line = read_next_line(server_in, server_out)
-        f, rcpt_addr = try_parse(rcpt_line, [parse_rcpt_to, parse_data_cmd], PARSERS)
+        rcpt_line = await read_next_line(server_in, server_out)
+        f, rcpt_addr = try_parse(rcpt_line, [parse_rcpt_to, parse_data_cmd], PARSERS, scanner)
     return rcpts
 
 
-def accept_data_entry(server_in, server_out):
-    print(ENTER_DATA_MSG, file=server_out, flush=True)
-    return parse_data_txt(server_in, server_out)
+async def accept_data_entry(server_in, server_out):
+    server_out.write(ENTER_DATA_REPLY)
+    return await parse_data_txt(server_in, server_out)
 
 
-def accept_mail_from(server_in, server_out):
-    mail_from = read_next_line(server_in, server_out)
-    f, from_addr = try_parse(mail_from, [parse_mail_from_cmd], PARSERS)
-    print(OK_MSG, file=server_out, flush=True)
-    rcpts = accept_rcpt_to(server_in, server_out)
-    text = accept_data_entry(server_in, server_out)
-    print(OK_MSG, file=server_out, flush=True)
+async def accept_mail_from(server_in, server_out, scanner):
+    mail_from = await read_next_line(server_in, server_out)
+    f, from_addr = try_parse(mail_from, [parse_mail_from_cmd], PARSERS, scanner)
+    server_out.ok()
+    rcpts = await accept_rcpt_to(server_in, server_out, scanner)
+    text = await accept_data_entry(server_in, server_out)
+    server_out.ok()
     return Mail(from_addr, rcpts, text)
 
 
 def mail_to_string(mail):
-    result = []
-    result.append("From: ")
-    result.append("<")
-    result.append(str(mail.src))
-    result.append(">\n")
-    for rcpt in mail.targets:
-        result.append("To: ")
-        result.append("<")
-        result.append(str(rcpt))
-        result.append(">\n")
-    result.append(mail.text)
-    return "".join(result)
+    rcpts = "".join("To: <%s>\n" % rcpt for rcpt in mail.targets)
+    return "From: <%s>\n%s%s" % (mail.src, rcpts, mail.text)
+
+
+def get_forward_file(domain):
+    fd = forward_files.pop(domain, None)
+    if fd is None:
+        if len(forward_files) >= MAX_FORWARD_FILES:
+            os.close(forward_files.pop(next(iter(forward_files))))
+        fd = os.open(FORWARD_DIR + domain, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    forward_files[domain] = fd
+    return fd
+
 
+def close_forward_files():
+    for fd in forward_files.values():
+        os.close(fd)
+    forward_files.clear()
 
-def accept_helo(server_in, server_out):
-    helo = read_next_line(server_in, server_out)
-    f, helo_msg = try_parse(helo, (parse_helo_cmd,), PARSERS)
-    print("%d %s pleased to meet you" % (OK, helo_msg), file=server_out, flush=True)
 
+def save_mail(mail):
+    mail_to_save = mail_to_string(mail).encode()
+    for domain in set(box.domain for box in mail.targets):
+        os.write(get_forward_file(domain), mail_to_save)
 
-def process_request(client_conn):
+
+async def accept_helo(server_in, server_out, scanner):
+    helo = await read_next_line(server_in, server_out)
+    f, helo_msg = try_parse(helo, (parse_helo_cmd, parse_ehlo_cmd), PARSERS, scanner)
+    if f == parse_ehlo_cmd:
+        server_out.send("%d-%s pleased to meet you" % (OK, helo_msg))
+        server_out.write(EXTENSIONS_REPLY)
+    else:
+        server_out.send("%d %s pleased to meet you" % (OK, helo_msg))
+
+
+async def process_request(reader, writer):
+    writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    server_out = Responder(writer)
     try:
-        with client_conn.makefile(mode="r", newline="\n") as server_in, client_conn.makefile(mode="w") as server_out:
-            helo_accepted = False
-            print("%d %s" % (GREETING, HOST_NAME), file=server_out, flush=True)
-            while not helo_accepted:
-                try:
-                    accept_helo(server_in, server_out)
-                    helo_accepted = True
-                except ParseException as e:
-                    print(e.args[0], file=server_out, flush=True)
-            while True:
-                try:
-                    mail = accept_mail_from(server_in, server_out)
-                    mail_to_save = mail_to_string(mail)
-                    file_names = set([box.domain for box in mail.targets])
-                    for file_name in file_names:
-                        with open("forward/" + file_name, "a") as file:
-                            file.write(mail_to_save)
-                except ParseException as e:
-                    print(e.args[0], file=server_out, flush=True)
+        server_in = ClientReader(reader)
+        scanner = TokenScanner(io.StringIO())
+        helo_accepted = False
+        server_out.write(GREETING_REPLY)
+        while not helo_accepted:
+            try:
+                await accept_helo(server_in, server_out, scanner)
+                helo_accepted = True
+            except ParseException as e:
+                server_out.write(e.reply)
+            except ClientReset:
+                server_out.ok()
+        while True:
+            try:
+                mail = await accept_mail_from(server_in, server_out, scanner)
+                save_mail(mail)
+            except ParseException as e:
+                server_out.write(e.reply)
+            except ClientReset:
+                server_out.ok()
     except ClientQuit:
         return
     except Exception as final_error:
         print(final_error)
+        try:
+            await server_out.flush()
+        except OSError:
+            pass
     finally:
-        client.shutdown(socket.SHUT_RDWR)
-        client_conn.close()
+        server_out.close()
 
 
-if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Please specify only the port number")
-        exit(0)
-    try:
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    except Exception as e:
-        print(e)
-        exit(0)
+async def serve(server_socket):
+    server = await asyncio.start_server(process_request, sock=server_socket)
+    async with server:
+        await server.serve_forever()
+
+
+def create_server_socket(port):
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     try:
-        PORT = int(sys.argv[1])
-        server_socket.bind(("", PORT))
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, "SO_REUSEPORT"):
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+        server_socket.bind(("", port))
         server_socket.listen(MAX_CONN_QUEUE)
+    except Exception:
+        server_socket.close()
+        raise
+    return server_socket
 
-        while True:
-            client, addr = server_socket.accept()
-            process = mtp.Process(target=process_request, args=(client,))
-            process.start()
 
+def run_worker(port):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    try:
+        server_socket = create_server_socket(port)
+    except Exception as e:
+        print(e)
+        return
+    try:
+        asyncio.run(serve(server_socket))
+    except KeyboardInterrupt:
+        pass
     except Exception as e:
         print(e)
     finally:
-        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        close_forward_files()
         server_socket.close()
 
+
+def stop_server(signum, frame):
+    exit(0)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Please specify only the port number")
+        exit(0)
+    try:
+        PORT = int(sys.argv[1])
+    except ValueError as e:
+        print(e)
+        exit(0)
+    worker_count = (os.cpu_count() or 1) if hasattr(socket, "SO_REUSEPORT") else 1
+    workers = [mtp.Process(target=run_worker, args=(PORT,)) for _ in range(worker_count)]
+    signal.signal(signal.SIGTERM, stop_server)
+    try:
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
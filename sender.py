@@ -1,6 +1,12 @@
-import io
+import functools
+import mmap
+import os
+import queue
+import re
+import stat
 import sys
 import socket
+import threading
 
 import parse
 from parse import ENTER_DATA
@@ -8,28 +14,90 @@ from parse import Mail
 from parse import OK
 from parse import GREETING
 from parse import ParseException
-from parse import TokenScanner
-from parse import parse_mailbox
+from parse import parse_mailbox_str
 
 
 INCORRECT_FROM_PATH = "Incorrect from path, please try again"
 INCORRECT_TO_PATH = "Incorrect to path, please try again"
+INCORRECT_TO_ADDRESSES = "Incorrect to address(es) %s, please enter only those again (kept %s)"
 UNCLEAN_EXIT = "Failed to gracefully quit from server"
 UNEXPECTED_CONNECTION_CLOSE = "Server closed connection unexpectedly"
 FAILED_TO_ENTER_MAIL_FROM = "Server did not accept source address"
 FAILED_TO_ENTER_RCPTS = "Server did not accept recipients"
+SOME_RCPTS_REJECTED = "Server did not accept some recipients, sending to the rest"
 SERVER_NOT_READY_FOR_DATA = "Server did not want to accept message data"
 SERVER_REJECT_DATA = "Server rejected message data"
 INVALID_SERVER_GREETING = "Server failed to greet properly"
-
-
-CONNECTION_TIMEOUT = 5
-
-
-def try_parse_mailbox(line):
-    stream = io.StringIO(line)
-    tok_scanner = TokenScanner(stream)
-    return parse_mailbox(tok_scanner)
+SERVER_REJECT_RESET = "Server did not accept reset"
+UNSENT_MAILS = "%d mail(s) were not sent"
+
+ADDRESS_LIST_RE = re.compile("(?:^|,)([^,]*)")
+WHITESPACE_RE = re.compile("\\s")
+
+# Bytes allowed in a reply line: printable ASCII, tab and line endings
+REPLY_TEXT = bytes(c for c in range(256) if 0x20 <= c < 0x7f or c in (0x09, 0x0A, 0x0D))
+
+QUIT_CMD = b"QUIT\r\n"
+RSET_CMD = b"RSET\r\n"
+DATA_CMD = b"DATA\r\n"
+DOT_LINE = b".\r\n"
+MAIL_FROM_CMD = b"MAIL FROM: <%s>\r\n"
+RCPT_TO_CMD = b"RCPT TO: <%s>\r\n"
+
+
+CONNECT_TIMEOUT = 2
+IO_TIMEOUT = 5
+ALL_ERRORS = sys.version_info >= (3, 11)
+CONNECT_ERRORS = (OSError, ExceptionGroup) if ALL_ERRORS else OSError
+RECV_SIZE = 4096
+DATA_CHUNK_SIZE = 65536
+SOCKET_BUFFER_SIZE = 16384
+TCP_QUICKACK = getattr(socket, "TCP_QUICKACK", None)
+TCP_USER_TIMEOUT = getattr(socket, "TCP_USER_TIMEOUT", None)
+
+
+class ServerReader:
+    __slots__ = ("client_sock", "buf")
+
+    def __init__(self, client_sock):
+        self.client_sock = client_sock
+        self.buf = bytearray()
+
+    def readline(self):
+        end = self.buf.find(b"\n")
+        while end < 0:
+            searched = len(self.buf)
+            chunk = self.client_sock.recv(RECV_SIZE)
+            if not chunk:
+                return b""
+            if TCP_QUICKACK is not None:
+                self.client_sock.setsockopt(socket.IPPROTO_TCP, TCP_QUICKACK, 1)
+            self.buf += chunk
+            end = self.buf.find(b"\n", searched)
+        line = bytes(self.buf[:end + 1])
+        del self.buf[:end + 1]
+        return line
+
+
+def mapped_lines(file):
+    fd = file.fileno()
+    start = os.lseek(fd, 0, os.SEEK_CUR)
+    with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mapped:
+        end = mapped.find(b"\n", start)
+        while end >= 0:
+            line_end = end - 1 if end > start and mapped[end - 1] == 13 else end
+            yield mapped[start:line_end].decode(file.encoding) + "\n"
+            start = end + 1
+            end = mapped.find(b"\n", start)
+        if start < len(mapped):
+            yield mapped[start:].decode(file.encoding)
+
+
+def input_lines(file):
+    info = os.fstat(file.fileno())
+    if stat.S_ISREG(info.st_mode) and info.st_size > 0:
+        return mapped_lines(file)
+    return file
 
 
 def read_from_line(file):
@@ -38,139 +106,230 @@ def read_from_line(file):
         print("From:")
         from_line = next(file)
         try:
-            parsed = try_parse_mailbox(from_line)
+            parsed = str(parse_mailbox_str(from_line))
         except ParseException:
             print(INCORRECT_FROM_PATH)
     return parsed
 
 
+def parse_address(address):
+    if "@" not in address or WHITESPACE_RE.search(address):
+        return None
+    try:
+        return str(parse_mailbox_str(address))
+    except ParseException:
+        return None
+
+
 def read_to_lines(file):
     result = []
-    while len(result) == 0:
+    failed = True
+    while failed or len(result) == 0:
         print("To:")
         to_combo = next(file)
-        separate_tos = [s.strip() for s in to_combo.split(",")]
-        try:
-            for to_line in separate_tos:
-                parsed = try_parse_mailbox(to_line)
+        failed = []
+        for match in ADDRESS_LIST_RE.finditer(to_combo):
+            address = match.group(1).strip()
+            parsed = parse_address(address)
+            if parsed is None:
+                failed.append(address)
+            elif parsed not in result:
                 result.append(parsed)
-        except ParseException:
+        if failed and result:
+            print(INCORRECT_TO_ADDRESSES % (", ".join("<%s>" % addr for addr in failed),
+                                            ", ".join("<%s>" % addr for addr in result)))
+        elif failed:
             print(INCORRECT_TO_PATH)
-            result = []
     return result
 
 
-def read_data(file):
+def read_data(file, lines):
     print("Subject:")
-    result = ["Subject: %s" % next(file), "\n"]
+    lines.append("Subject: %s" % next(file))
+    lines.append("\n")
     print("Message:")
     while True:
         data_line = next(file)
         if data_line == ".\n":
             break
-        result.append(data_line)
-    return "".join(result)
+        lines.append(data_line)
 
 
 def read_mail(file):
     from_header = read_from_line(file)
     to_headers = read_to_lines(file)
-    data = read_data(file)
-    header = ["From: ", "<%s>\n" % from_header, "To: "]
-    for to in to_headers:
-        header.append("<%s>" % str(to))
-        header.append(", ")
-    del header[-1]
-    header.append("\n")
-    data = "".join(header) + data
-    return Mail(from_header, to_headers, data)
+    to_str = ", ".join("<%s>" % to for to in to_headers)
+    lines = ["From: <%s>\nTo: %s\n" % (from_header, to_str)]
+    read_data(file, lines)
+    return Mail(from_header, to_headers, lines)
 
 
-def read_server_output(stream):
+def read_server_line(stream):
     try:
-        output = next(stream)
-        return output
-    except (IOError, StopIteration):
+        output = stream.readline()
+    except IOError:
+        output = None
+    if not output:
         print(UNEXPECTED_CONNECTION_CLOSE)
         exit(0)
+    return output
+
+
+def read_reply_lines(stream):
+    lines = [read_server_line(stream)]
+    while len(lines[-1]) > 3 and lines[-1][3] == 0x2D:
+        lines.append(read_server_line(stream))
+    return lines
+
+
+def read_server_output(stream):
+    return read_reply_lines(stream)[-1]
 
 
 def match_code(resp, code):
-    if len(resp) < 3:
+    if len(resp) < 5 or resp[3] not in (0x20, 0x09) or resp.translate(None, REPLY_TEXT):
         return False
-    resp = resp.strip()
-    code_str = resp[:3]
-    if not code_str.isdigit():
-        return False
-    if resp == code_str:
-        return False
-    if resp[3] != " " and resp[3] != "\t":
-        return False
-    if len(resp[4:]) == 0 or not resp[4:].isascii():
-        return False
-    code_int = int(code_str)
-    return code == code_int
+    return resp[:3] == b"%d" % code
 
 
-def exit_sequence(server_in, server_out):
-    print("QUIT", file=server_out, flush=True)
+def send_cmd(client_sock, line):
+    client_sock.sendall(line)
+
+
+def exit_sequence(server_in, client_sock, status=0):
+    send_cmd(client_sock, QUIT_CMD)
     goodbye = read_server_output(server_in)
     if match_code(goodbye, parse.QUIT):
-        exit(0)
+        exit(status)
     else:
         print(UNCLEAN_EXIT)
-        exit(0)
+        exit(status)
 
 
-def handle_mail_from(from_addr, server_in, server_out):
-    print("MAIL FROM: <%s>" % from_addr, file=server_out, flush=True)
+def reset_sequence(server_in, client_sock):
+    send_cmd(client_sock, RSET_CMD)
+    resp = read_server_output(server_in)
+    if not match_code(resp, OK):
+        print(SERVER_REJECT_RESET)
+        exit_sequence(server_in, client_sock, 1)
+
+
+def handle_mail_from(from_addr, server_in, client_sock):
+    send_cmd(client_sock, MAIL_FROM_CMD % from_addr.encode())
     resp = read_server_output(server_in)
     if not match_code(resp, OK):
         print(FAILED_TO_ENTER_MAIL_FROM)
-        exit_sequence(server_in, server_out)
+        return False
+    return True
 
 
-def handle_mail_to(to_addrs, server_in, server_out):
+def handle_mail_to(to_addrs, server_in, client_sock):
+    accepted = 0
     for addr in to_addrs:
-        print("RCPT TO: <%s>" % str(addr), file=server_out, flush=True)
-        resp = read_server_output(server_in)
-        if not match_code(resp, OK):
-            print(FAILED_TO_ENTER_RCPTS)
-            exit_sequence(server_in, server_out)
+        send_cmd(client_sock, RCPT_TO_CMD % addr.encode())
+        if match_code(read_server_output(server_in), OK):
+            accepted += 1
+    return check_rcpts(accepted, len(to_addrs))
 
 
-def handle_data(data, server_in, server_out):
-    print("DATA", file=server_out, flush=True)
+def check_rcpts(accepted, total):
+    if accepted == 0:
+        print(FAILED_TO_ENTER_RCPTS)
+        return False
+    if accepted < total:
+        print(SOME_RCPTS_REJECTED)
+    return True
+
+
+def handle_data(data, server_in, client_sock):
+    send_cmd(client_sock, DATA_CMD)
     resp = read_server_output(server_in)
     if not match_code(resp, ENTER_DATA):
         print(SERVER_NOT_READY_FOR_DATA)
-        exit_sequence(server_in, server_out)
-    print(data, file=server_out, end="", flush=True)
-    if len(data) == 0:
-        print(".", file=server_out, flush=True)
-    elif data[-1] == "\n":
-        print(".", file=server_out, flush=True)
-    else:
-        print("\n.", file=server_out, flush=True)
+        return False
+    return send_data(data, server_in, client_sock)
+
+
+def data_chunks(lines):
+    chunk = []
+    size = 0
+    for line in lines:
+        chunk.append(line)
+        size += len(line)
+        if size >= DATA_CHUNK_SIZE:
+            yield "".join(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        yield "".join(chunk)
+
+
+def send_data(lines, server_in, client_sock):
+    payload = b""
+    for chunk in data_chunks(lines):
+        if payload:
+            send_cmd(client_sock, payload)
+        payload = chunk.replace("\r\n", "\n").replace("\n", "\r\n").encode().replace(b"\n.", b"\n..")
+        if payload[:1] == b".":
+            payload = b"." + payload
+    if payload and payload[-1:] != b"\n":
+        payload += b"\r\n"
+    send_cmd(client_sock, payload + DOT_LINE)
     resp = read_server_output(server_in)
     if not match_code(resp, OK):
         print(SERVER_REJECT_DATA)
-        exit_sequence(server_in, server_out)
+        return False
+    return True
+
+
+def handle_pipelined(mail, server_in, client_sock):
+    commands = [MAIL_FROM_CMD % mail.src.encode()]
+    commands.extend(RCPT_TO_CMD % addr.encode() for addr in mail.targets)
+    commands.append(DATA_CMD)
+    send_cmd(client_sock, b"".join(commands))
+    from_accepted = match_code(read_server_output(server_in), OK)
+    rcpt_replies = [read_server_output(server_in) for _ in mail.targets]
+    data_ready = match_code(read_server_output(server_in), ENTER_DATA)
+    accepted = sum(match_code(resp, OK) for resp in rcpt_replies)
+    if not from_accepted:
+        print(FAILED_TO_ENTER_MAIL_FROM)
+        if data_ready and accepted:
+            # Ending the data here would deliver an empty mail, so drop the connection instead
+            exit(1)
+    elif check_rcpts(accepted, len(mail.targets)):
+        if data_ready:
+            return send_data(mail.text, server_in, client_sock)
+        print(SERVER_NOT_READY_FOR_DATA)
+        return False
+    if data_ready:
+        send_cmd(client_sock, DOT_LINE)
+        read_server_output(server_in)
+    return False
 
 
-def greeting_sequence(server_in, server_out):
-    domain = get_my_domain()
+def greeting_sequence(server_in, client_sock):
     server_greeting = read_server_output(server_in)
     if not match_code(server_greeting, GREETING):
         print(INVALID_SERVER_GREETING)
-        exit_sequence(server_in, server_out)
-    print("HELO %s" % domain, file=server_out, flush=True)
+        exit_sequence(server_in, client_sock)
+    send_cmd(client_sock, greeting_cmd(b"EHLO"))
+    server_resp = read_reply_lines(server_in)
+    if match_code(server_resp[-1], OK):
+        return set(line[4:].split()[0].upper() for line in server_resp[1:] if line[4:].split())
+    send_cmd(client_sock, greeting_cmd(b"HELO"))
     server_resp = read_server_output(server_in)
     if not match_code(server_resp, OK):
         print(INVALID_SERVER_GREETING)
-        exit_sequence(server_in, server_out)
+        exit_sequence(server_in, client_sock)
+    return set()
+
 
+@functools.lru_cache(maxsize=None)
+def greeting_cmd(verb):
+    return b"%s %s\r\n" % (verb, get_my_domain().encode())
 
+
+@functools.lru_cache(maxsize=1)
 def get_my_domain():
     fqdn = socket.getfqdn()
     separated = fqdn.split(".")
@@ -180,30 +339,77 @@ def get_my_domain():
         return ".".join(separated[1:])
 
 
-def process_mails(host, port):
+def read_next_mail(lines):
     try:
-        next_mail = read_mail(sys.stdin)
-        if not next_mail:
-            return
+        return read_mail(lines)
     except StopIteration:
-        return
+        return None
     except IOError as e:
         print(e)
-        return
+        return None
+
+
+def read_mails(file, mails):
     try:
-        client_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client_sock.settimeout(CONNECTION_TIMEOUT)
-        client_sock.connect((host, port))
-    except OSError as e:
-        print(e)
+        lines = input_lines(file)
+        next_mail = read_next_mail(lines)
+        while next_mail:
+            mails.put(next_mail)
+            next_mail = read_next_mail(lines)
+    finally:
+        mails.put(None)
+
+
+def open_session(host, port):
+    if ALL_ERRORS:
+        client_sock = socket.create_connection((host, port), timeout=CONNECT_TIMEOUT, all_errors=True)
+    else:
+        client_sock = socket.create_connection((host, port), timeout=CONNECT_TIMEOUT)
+    try:
+        client_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client_sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+        client_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+        if TCP_USER_TIMEOUT is not None:
+            client_sock.setsockopt(socket.IPPROTO_TCP, TCP_USER_TIMEOUT, IO_TIMEOUT * 1000)
+        client_sock.settimeout(IO_TIMEOUT)
+    except OSError:
+        client_sock.close()
+        raise
+    return client_sock
+
+
+def send_one(mail, server_in, client_sock, pipelining):
+    if pipelining:
+        return handle_pipelined(mail, server_in, client_sock)
+    return (handle_mail_from(mail.src, server_in, client_sock)
+            and handle_mail_to(mail.targets, server_in, client_sock)
+            and handle_data(mail.text, server_in, client_sock))
+
+
+def process_mails(host, port):
+    mails = queue.Queue()
+    reader = threading.Thread(target=read_mails, args=(sys.stdin, mails), daemon=True)
+    reader.start()
+    try:
+        client_sock = open_session(host, port)
+    except CONNECT_ERRORS as e:
+        for error in getattr(e, "exceptions", (e,)):
+            print(error)
         return
     try:
-        with client_sock.makefile(mode="r", newline="\n") as server_in, client_sock.makefile(mode="w") as server_out:
-            greeting_sequence(server_in, server_out)
-            handle_mail_from(next_mail.src, server_in, server_out)
-            handle_mail_to(next_mail.targets, server_in, server_out)
-            handle_data(next_mail.text, server_in, server_out)
-            exit_sequence(server_in, server_out)
+        server_in = ServerReader(client_sock)
+        extensions = greeting_sequence(server_in, client_sock)
+        pipelining = b"PIPELINING" in extensions
+        unsent = 0
+        next_mail = mails.get()
+        while next_mail:
+            if not send_one(next_mail, server_in, client_sock, pipelining):
+                unsent += 1
+                reset_sequence(server_in, client_sock)
+            next_mail = mails.get()
+        if unsent:
+            print(UNSENT_MAILS % unsent)
+        exit_sequence(server_in, client_sock, 1 if unsent else 0)
     finally:
         client_sock.shutdown(socket.SHUT_RDWR)
         client_sock.close()